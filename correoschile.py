@@ -1,52 +1,213 @@
 """Utilities for tracking correoschile packages."""
 
-import requests
-import bs4
+import re
+import html
+import codecs
+import asyncio
 from datetime import datetime
 
+import aiohttp
+from lxml import etree
 
-def track(tracking_number):
-    """Get tracking updates from CorreosChile website."""
 
-    request_url = 'http://seguimientoweb.correos.cl/ConEnvCorreos.aspx'
+# Number of attempts for each request, with exponential backoff in between
+REQUEST_ATTEMPTS = 3
+MAX_CONCURRENT_REQUESTS = 8
+
+
+HTML_PARSER = etree.HTMLParser()
+ROW_XPATH = etree.XPath(
+    "//table[contains(concat(' ', normalize-space(@class), ' '),"
+    " ' tracking ')]//tr")
+
+# The tracking table is a flat list of rows with three plain text cells, so
+# in most cases it can be extracted with a regex without parsing the page
+TABLE_REGEX = re.compile(
+    rb'<table\b[^>]*?\sclass\s*=\s*["\']?(?:[^"\'>]*\s)?tracking(?=[\s"\'>])'
+    rb'[^>]*>(.*?)</table>',
+    re.IGNORECASE | re.DOTALL)
+ROW_REGEX = re.compile(
+    rb'<tr[^>]*>\s*<td[^>]*>([^<]*)</td>\s*<td[^>]*>([^<]*)</td>'
+    rb'\s*<td[^>]*>([^<]*)</td>\s*</tr>',
+    re.IGNORECASE)
+# Any data cell, used to check that ROW_REGEX didn't miss any row
+CELL_REGEX = re.compile(rb'<td\b', re.IGNORECASE)
+# TABLE_REGEX stops at the first '</table>', so a nested table cuts it short
+NESTED_TABLE_REGEX = re.compile(rb'<table\b', re.IGNORECASE)
+META_CHARSET_REGEX = re.compile(
+    rb'<meta[^>]+charset\s*=\s*["\']?([\w.:-]+)', re.IGNORECASE)
+
+# Dates in the tracking table have the format '%d/%m/%Y %H:%M'. Matching
+# them with a precompiled regex avoids the overhead of datetime.strptime
+DATE_REGEX = re.compile(r'(\d{2})/(\d{2})/(\d{4}) (\d{2}):(\d{2})')
+
+
+def parse_date(date_string):
+    """Parse a date from the tracking table."""
+
+    match = DATE_REGEX.match(date_string)
+    if match is None:
+        raise ValueError('Invalid date {!r}'.format(date_string))
+
+    day, month, year, hour, minute = match.groups()
+    return datetime(int(year), int(month), int(day), int(hour), int(minute))
+
+
+def check_encoding(encoding):
+    """Get the normalized name of an encoding, or None if it's unknown."""
+
+    try:
+        return codecs.lookup(encoding).name
+    except (LookupError, TypeError):
+        return None
+
+
+def find_encoding(content):
+    """Get the encoding declared by the <meta> tags of a page, if any."""
+
+    match = META_CHARSET_REGEX.search(content)
+    if match is None:
+        return None
+
+    return check_encoding(match.group(1).decode('ascii'))
+
+
+def parse_rows(content, encoding=None):
+    """Get the cell values of each row in the tracking table of a page.
+
+    The rows are matched with a regex, falling back to parsing the table
+    (or the whole page if the table can't be found, or contains another
+    table) if some rows could not be matched that way. 'encoding' is the
+    charset of the response, if known. Otherwise, the one declared by the
+    page is used.
+    """
+
+    encoding = check_encoding(encoding) or find_encoding(content)
+
+    # Without a known encoding, lxml is left to detect it from the page
+    table = TABLE_REGEX.search(content) if encoding is not None else None
+    if table is not None and NESTED_TABLE_REGEX.search(
+            content, *table.span(1)) is not None:
+        table = None
+
+    if table is not None:
+        rows = [
+            [html.unescape(x.decode(encoding, 'replace')).strip()
+             for x in match.groups()]
+            for match in ROW_REGEX.finditer(content, *table.span(1))
+        ]
+        cell_count = len(CELL_REGEX.findall(content, *table.span(1)))
+        if len(rows) > 0 and 3 * len(rows) == cell_count:
+            return rows
+
+        # Only the table needs to go through the parser
+        start, end = table.span()
+        root = etree.fromstring(
+            content[start:end].decode(encoding, 'replace'), HTML_PARSER)
+    else:
+        root = etree.fromstring(content, HTML_PARSER)
+    if root is None:
+        return []
 
-    tracking_page = requests.post(
-        request_url,
-        params={
-            'obj_key': 'Cor398-cc',  # key was hardcoded in the website
-            'obj_env': tracking_number
+    return [
+        [''.join(cell.itertext()).strip() for cell in row.findall('td')]
+        for row in ROW_XPATH(root)
+    ]
+
+
+def extract_updates(rows):
+    """Get the updates from the rows of the tracking table."""
+
+    updates = {}
+    for values in rows:
+        date = parse_date(values[1])
+        updates[date] = {
+            'status': values[0].capitalize(),
+            'location': values[2].capitalize()
         }
-    )
 
-    tracking_info = {
-        'updates': {},
-        'delivered': False,
+    return updates
+
+
+def extract_delivered(rows):
+    """Check the rows of the tracking table for a delivery update."""
+
+    return any(values[0].capitalize() == 'Envio entregado' for values in rows)
+
+
+async def fetch_page(session, tracking_number):
+    """Get the tracking page from CorreosChile website.
+
+    Returns the content of the page and its encoding (None if the response
+    doesn't specify it). Requests that fail with a connection error, a
+    timeout, or a 429 or 5xx response are retried with exponential backoff.
+    """
+
+    request_url = 'http://seguimientoweb.correos.cl/ConEnvCorreos.aspx'
+
+    params = {
+        'obj_key': 'Cor398-cc',  # key was hardcoded in the website
+        'obj_env': tracking_number
+    }
+
+    for attempt in range(REQUEST_ATTEMPTS):
+        try:
+            async with session.post(request_url, params=params) as response:
+                response.raise_for_status()
+                content = await response.read()
+                return content, response.charset
+        except aiohttp.ClientResponseError as error:
+            if error.status != 429 and error.status < 500:
+                raise
+            if attempt == REQUEST_ATTEMPTS - 1:
+                raise
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == REQUEST_ATTEMPTS - 1:
+                raise
+
+        await asyncio.sleep(2 ** attempt)
+
+
+async def track(session, tracking_number):
+    """Get tracking updates from CorreosChile website.
+
+    'session' is an aiohttp.ClientSession, so several tracking numbers can
+    be requested concurrently over the same session.
+    """
+
+    content, encoding = await fetch_page(session, tracking_number)
+
+    # The page is parsed only once, and the rows shared by all extractors
+    rows = [x for x in parse_rows(content, encoding) if len(x) == 3]
+
+    return {
+        'updates': extract_updates(rows),
+        'delivered': extract_delivered(rows),
         'url': (
             'https://www.correos.cl/SitePages/seguimiento/seguimiento.aspx'
             '?envio={}'.format(tracking_number)
         ),
     }
 
-    soup = bs4.BeautifulSoup(tracking_page.content, 'html.parser')
-    table = soup.find(class_='tracking')
-
-    if table is not None:
-        for row in table.find_all('tr'):
-            values = [cell.string.strip() for cell in row.find_all('td')]
 
-            if len(values) != 3:
-                continue
+async def track_many(tracking_numbers):
+    """Get tracking info for several tracking numbers concurrently.
 
-            date = datetime.strptime(values[1], '%d/%m/%Y %H:%M')
-            status = values[0].capitalize()
-            location = values[2].capitalize()
+    Returns a list with the tracking info (or the raised exception) of each
+    tracking number, in the same order as 'tracking_numbers'.
+    """
 
-            tracking_info['updates'][date] = {
-                'status': status,
-                'location': location
-            }
+    # Size the connection pool to the requests in flight, so each request
+    # reuses a kept-alive connection once the first ones are open
+    connector = aiohttp.TCPConnector(limit_per_host=MAX_CONCURRENT_REQUESTS)
+    # Limit the requests in flight to avoid being rate limited
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
-            if status == 'Envio entregado':
-                tracking_info['delivered'] = True
+    async def bounded_track(session, tracking_number):
+        async with semaphore:
+            return await track(session, tracking_number)
 
-    return tracking_info
+    async with aiohttp.ClientSession(connector=connector) as session:
+        return await asyncio.gather(
+            *(bounded_track(session, x) for x in tracking_numbers),
+            return_exceptions=True)
@@ -2,19 +2,42 @@
 
 import json
 import sys
-import smtplib
+import asyncio
 import argparse
 from datetime import datetime
+from functools import lru_cache
 from email.message import EmailMessage
 from collections import defaultdict
 
+import aiosmtplib
+import orjson
+
 import correoschile
 
 
 TIMESTAMP_FORMAT = '%Y.%m.%d %H:%M'
 
 
-def email_updates(
+@lru_cache(maxsize=512)
+def parse_timestamp(timestamp):
+    """Parse a timestamp from the log file."""
+
+    return datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+
+
+def format_timestamp(time):
+    """Format a datetime for the log file, as in TIMESTAMP_FORMAT.
+
+    Faster than strftime for this fixed format.
+    """
+
+    return (
+        f'{time.year:04d}.{time.month:02d}.{time.day:02d} '
+        f'{time.hour:02d}:{time.minute:02d}'
+    )
+
+
+async def email_updates(
         updates, smtp_server, sender, receiver,
         tls=True, user=None, password=None, **kwargs):
     """Send an email notification of package updates.
@@ -24,34 +47,37 @@ def email_updates(
     """
 
     # Build message body
-    message_body = '<p>Updates since last check:</p>'
+    message_parts = ['<p>Updates since last check:</p>']
     for category in updates:
         # Catergory title
-        message_body += '<p>'
+        message_parts.append('<p>')
         if type(category) is tuple:
-            message_body += '<a href={1}>{0}</a>'.format(*category)
+            message_parts.append('<a href={1}>{0}</a>'.format(*category))
         else:
-            message_body += category
-        message_body += '</p>'
+            message_parts.append(category)
+        message_parts.append('</p>')
 
         # Items
-        message_body += '<ul>'
+        message_parts.append('<ul>')
         for item in updates[category]:
-            message_body += '<li>'
-            message_body += '<b>{}</b> {} '.format(
-                item['time'].strftime('%c'), item['status'])
+            message_parts.append('<li>')
+            message_parts.append('<b>{}</b> {} '.format(
+                item['time'].strftime('%c'), item['status']))
             if 'location' in item:
-                message_body += '<i>({})</i>'.format(item['location'])
-            message_body += '</li>'
-        message_body += '</ul>'
-
-    # Send message
-    with smtplib.SMTP(smtp_server) as smtp:
-        if tls:
-            smtp.starttls()
-
+                message_parts.append('<i>({})</i>'.format(item['location']))
+            message_parts.append('</li>')
+        message_parts.append('</ul>')
+    message_body = ''.join(message_parts)
+
+    # Send message ('smtp_server' may include a port, as in smtplib, which
+    # also defaults to port 25 regardless of STARTTLS)
+    hostname, _, port = smtp_server.partition(':')
+    port = int(port) if port else 25
+
+    async with aiosmtplib.SMTP(
+            hostname=hostname, port=port, start_tls=tls) as smtp:
         if user is not None and password is not None:
-            smtp.login(user, password)
+            await smtp.login(user, password)
 
         msg = EmailMessage()
         msg['From'] = 'Package Tracking <{}>'.format(sender)
@@ -60,7 +86,7 @@ def email_updates(
 
         msg.set_content(message_body, subtype='html')
 
-        smtp.send_message(msg, sender, receiver)
+        await smtp.send_message(msg, sender, receiver)
 
 
 def main(argv):
@@ -73,11 +99,28 @@ def main(argv):
         return
 
     try:
-        with open('log.json', 'r') as log_file:
-            tracking_log = json.load(log_file)
+        with open('log.json', 'rb') as log_file:
+            tracking_log = orjson.loads(log_file.read())
     except IOError:
         tracking_log = {}
 
+    # Check times are kept apart from the log, since they change on every
+    # run and would otherwise force the whole log to be rewritten
+    try:
+        with open('last_check.json', 'rb') as last_check_file:
+            last_checks = orjson.loads(last_check_file.read())
+    except IOError:
+        last_checks = {}
+
+    # Move check times left in the log by older versions to the sidecar file
+    log_changed = False
+    for number, entry in tracking_log.items():
+        if 'last_check' in entry:
+            last_check = entry.pop('last_check')
+            if last_check is not None:
+                last_checks.setdefault(number, last_check)
+            log_changed = True
+
     # Argument parser
     parser = argparse.ArgumentParser(description=__doc__)
     subparsers = parser.add_subparsers(dest='command', title='commands')
@@ -87,32 +130,59 @@ def main(argv):
 
     # Add tracking number (if the 'track' command was selected)
     # TODO: Move to separate function
+    settings_changed = False
     if args.command == 'track':
         settings['tracking_numbers'].append(args.tracking_number)
+        settings_changed = True
 
     # Check for updates
     tracking_updates = defaultdict(list)
+    check_time = format_timestamp(datetime.now())
+
+    # Packages already delivered are not checked again, unless they have
+    # just been added with the 'track' command
+    tracking_numbers = []
+    finished = set()
+    for number in settings['tracking_numbers']:
+        delivered = tracking_log.get(number, {}).get('delivered')
+        if not delivered or number == getattr(args, 'tracking_number', None):
+            tracking_numbers.append(number)
+        elif settings['autoremove']:
+            new_update = {
+                'time': datetime.now(),
+                'status': 'Finished tracking {}'.format(number),
+            }
+
+            tracking_updates['System'].append(new_update)
+            finished.add(number)
+
+    # Get info from tracking website
+    results = asyncio.run(correoschile.track_many(tracking_numbers))
+
+    for number, tracking_info in zip(tracking_numbers, results):
+        if isinstance(tracking_info, Exception):
+            print('Could not track {}: {!r}'.format(number, tracking_info))
+            continue
 
-    for number in settings['tracking_numbers'][:]:
         # Create entry for new tracking number
         if number not in tracking_log:
             tracking_log[number] = {
-                'last_check': None,
                 'last_update': None,
                 'delivered': False,
                 'updates': {}
             }
+            log_changed = True
         entry = tracking_log[number]
 
-        # Get info from tracking website
-        tracking_info = correoschile.track(number)
         updates = tracking_info['updates']
 
         # Update check time
-        entry['last_check'] = datetime.now().strftime(TIMESTAMP_FORMAT)
+        last_checks[number] = check_time
 
         # Remove from settings if package has been delivered
-        entry['delivered'] = tracking_info['delivered']
+        if entry['delivered'] != tracking_info['delivered']:
+            entry['delivered'] = tracking_info['delivered']
+            log_changed = True
         if entry['delivered'] and settings['autoremove']:
             new_update = {
                 'time': datetime.now(),
@@ -120,18 +190,18 @@ def main(argv):
             }
 
             tracking_updates['System'].append(new_update)
-            settings['tracking_numbers'].remove(number)
+            finished.add(number)
 
         # Check if new updates have been made
         if len(updates) == 0:
             continue
 
         try:
-            last_update = datetime.strptime(
-                entry['last_update'], TIMESTAMP_FORMAT)
+            last_update = parse_timestamp(entry['last_update'])
         except TypeError:
             last_update = None
 
+        latest_update = None
         for time, status in updates.items():
             category = (number, tracking_info['url'])
             if last_update is None or time > last_update:
@@ -139,21 +209,45 @@ def main(argv):
                 new_update['time'] = time
                 tracking_updates[category].append(new_update)
 
-        # Update entry in the log
-        entry['updates'].update(
-            {x.strftime(TIMESTAMP_FORMAT): updates[x] for x in updates})
-        entry['last_update'] = max(updates.keys()).strftime(TIMESTAMP_FORMAT)
+            if latest_update is None or time > latest_update:
+                latest_update = time
 
-    # Write updated log and settings file
-    with open('log.json', 'w') as log_file:
-        json.dump(tracking_log, log_file, indent=4, sort_keys=True)
+            # Add update to the log entry
+            key = format_timestamp(time)
+            if key not in entry['updates']:
+                entry['updates'][key] = status
+                log_changed = True
 
-    with open('settings.json', 'w') as settings_file:
-        json.dump(settings, settings_file, indent=4, sort_keys=True)
+        # Update entry in the log
+        latest_update = format_timestamp(latest_update)
+        if entry['last_update'] != latest_update:
+            entry['last_update'] = latest_update
+            log_changed = True
+
+    # Remove delivered packages from settings
+    if len(finished) > 0:
+        settings['tracking_numbers'] = [
+            x for x in settings['tracking_numbers'] if x not in finished]
+        settings_changed = True
+
+    # Write updated log and settings file (only if they have changed)
+    if log_changed:
+        with open('log.json', 'wb') as log_file:
+            log_file.write(orjson.dumps(
+                tracking_log,
+                option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
+
+    if settings_changed:
+        with open('settings.json', 'w') as settings_file:
+            json.dump(settings, settings_file, indent=4, sort_keys=True)
+
+    with open('last_check.json', 'wb') as last_check_file:
+        last_check_file.write(orjson.dumps(
+            last_checks, option=orjson.OPT_SORT_KEYS))
 
     # Send updates
     if len(tracking_updates) > 0 and settings['alert']:
-        email_updates(tracking_updates, **settings['email'])
+        asyncio.run(email_updates(tracking_updates, **settings['email']))
 
 
 if __name__ == '__main__':